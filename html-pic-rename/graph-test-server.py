@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+
+# A local stand-in for OneDrive's Graph api, for testing the web app in this directory without a OneDrive account.
+#   graph-test-server.py DIR        serves DIR, for the web app's ?graph= or its console's testRenameFolderAsync
+#   graph-test-server.py --test     checks the server, and then drives the web app's rename against it with node
+
+from __future__ import annotations
+import sys
+import argparse
+import collections
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+class GraphServer:
+    # A local stand-in for OneDrive's Graph api, for testing the web app against the files under dir.
+    # It serves folder listings, thumbnails, download urls that honour Range, and renames: PATCH of a single item,
+    # and POST of a $batch of up to 20 of them, each answered on its own with 200, or 409 if the name is taken.
+    # Every item gets an id when it's first listed, which it keeps when renamed. A fraction `errors` of the renames
+    # in a batch are answered 429 with a Retry-After, and every response can be delayed by `latency` seconds.
+    # Any origin may call it, since the web app is served from elsewhere.
+    BATCH_LIMIT = 20
+
+    def __init__(self, dir : str, port : int = 0, latency : float = 0.0, errors : float = 0.0, seed : int = 0):
+        import http.server
+        import random
+        (self.dir, self.latency, self.errors, self.random) = (os.path.abspath(dir), latency, errors, random.Random(seed))
+        self.paths : Dict[str, str] = {'root': self.dir} # by item id
+        self.ids : Dict[str, str] = {self.dir: 'root'} # by path
+        self.lock = threading.Lock()
+        self.counts : Dict[str, int] = collections.Counter() # of requests, by kind
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_OPTIONS(self) -> None:
+                server.send(self, 204, b'')
+            def do_HEAD(self) -> None:
+                server.respond(self, 'HEAD', b'')
+            def do_GET(self) -> None:
+                server.respond(self, 'GET', b'')
+            def do_PATCH(self) -> None:
+                server.respond(self, 'PATCH', self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            def do_POST(self) -> None:
+                server.respond(self, 'POST', self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            def log_message(self, format : str, *args : Any) -> None:
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def item(self, path : str) -> Dict[str, Any]:
+        id = self.ids.get(path)
+        if id is None:
+            id = f'item{len(self.paths):06}'
+            (self.paths[id], self.ids[path]) = (path, id)
+        size = os.path.getsize(path) if not os.path.isdir(path) else sum(os.path.getsize(os.path.join(dir, name)) for (dir, _, names) in os.walk(path) for name in names)
+        item : Dict[str, Any] = {'name': os.path.basename(path), 'id': id, 'size': size, 'webUrl': f'{self.url}/content/{id}'}
+        if os.path.isdir(path):
+            item['folder'] = {'childCount': len(os.listdir(path))}
+        else:
+            (item['file'], item['@microsoft.graph.downloadUrl']) = ({}, f'{self.url}/content/{id}')
+        return item
+
+    def rename(self, id : str, name : Any) -> Tuple[int, Dict[str, Any]]:
+        # (status, body) of a PATCH of item id to name
+        path = self.paths.get(id)
+        if path is None:
+            return (404, {'error': {'code': 'itemNotFound', 'message': 'Item not found'}})
+        if not isinstance(name, str) or name in ['', '.', '..'] or '/' in name:
+            return (400, {'error': {'code': 'invalidRequest', 'message': 'Invalid name'}})
+        dst = os.path.join(os.path.dirname(path), name)
+        if dst != path and name.casefold() in {other.casefold() for other in os.listdir(os.path.dirname(path))}:
+            return (409, {'error': {'code': 'nameAlreadyExists', 'message': 'The specified item name already exists.'}})
+        os.rename(path, dst)
+        del self.ids[path]
+        (self.paths[id], self.ids[dst]) = (dst, id)
+        return (200, self.item(dst))
+
+    def respond(self, handler : Any, verb : str, body : bytes) -> None:
+        time.sleep(self.latency)
+        path = handler.path.split('?')[0]
+        match = re.match(r'^/v1.0/me/drive/(?:root|items/([^/]+))(/children|/thumbnails/0/small)?$', path)
+        try:
+            payload = json.loads(body) if len(body) > 0 else {}
+        except ValueError:
+            self.send_json(handler, 400, {'error': {'code': 'invalidRequest', 'message': 'Invalid json'}})
+            return
+        with self.lock:
+            if path.startswith('/content/'):
+                self.counts['content'] += 1
+                self.send_content(handler, verb, self.paths.get(path[len('/content/'):]))
+            elif verb == 'POST' and path == '/v1.0/$batch':
+                self.counts['batch'] += 1
+                requests = payload.get('requests', [])
+                if len(requests) > GraphServer.BATCH_LIMIT:
+                    self.send_json(handler, 400, {'error': {'code': 'invalidRequest', 'message': f'at most {GraphServer.BATCH_LIMIT} requests in a batch'}})
+                    return
+                responses = []
+                for request in requests:
+                    self.counts['batched_rename'] += 1
+                    request_match = re.match(r'^/me/drive/items/([^/]+)$', request['url'])
+                    if request['method'] != 'PATCH' or request_match is None:
+                        (status, response, headers) = (400, {'error': {'code': 'invalidRequest', 'message': 'only renames are supported'}}, {})
+                    elif self.random.random() < self.errors:
+                        (status, response, headers) = (429, {'error': {'code': 'activityLimitReached', 'message': 'Too many requests'}}, {'Retry-After': '1'})
+                    else:
+                        ((status, response), headers) = (self.rename(request_match.group(1), request.get('body', {}).get('name')), {})
+                    responses.append({'id': request['id'], 'status': status, 'headers': headers, 'body': response})
+                self.send_json(handler, 200, {'responses': responses})
+            elif match is None or self.paths.get(match.group(1) or 'root') is None:
+                self.send_json(handler, 404, {'error': {'code': 'itemNotFound', 'message': 'Item not found'}})
+            elif verb == 'PATCH':
+                self.counts['rename'] += 1
+                self.send_json(handler, *self.rename(match.group(1), payload.get('name')))
+            elif match.group(2) == '/children':
+                self.counts['children'] += 1
+                dir = self.paths[match.group(1) or 'root']
+                self.send_json(handler, 200, {'value': [self.item(os.path.join(dir, name)) for name in sorted(os.listdir(dir))]})
+            elif match.group(2) is not None:
+                self.counts['thumbnail'] += 1
+                self.send_json(handler, 200, {'url': f'{self.url}/content/{match.group(1)}', 'width': 96, 'height': 96})
+            else:
+                self.send_json(handler, 200, self.item(self.paths[match.group(1) or 'root']))
+
+    def send_content(self, handler : Any, verb : str, path : Optional[str]) -> None:
+        # The whole file, or a single "Range: bytes=a-b"
+        if path is None or not os.path.isfile(path):
+            self.send(handler, 404, b'')
+            return
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            ranged = re.match(r'^bytes=(\d+)-(\d*)$', handler.headers.get('Range', ''))
+            (status, start, end) = (200, 0, size) if ranged is None else (206, int(ranged.group(1)), min(int(ranged.group(2) or size - 1) + 1, size))
+            if start >= end and status == 206:
+                self.send(handler, 416, b'', {'Content-Range': f'bytes */{size}'})
+                return
+            file.seek(start)
+            body = file.read(end - start) if verb != 'HEAD' else b''
+        self.send(handler, status, body, {'Content-Range': f'bytes {start}-{end - 1}/{size}'} if status == 206 else {}, end - start)
+
+    def send_json(self, handler : Any, status : int, body : Dict[str, Any]) -> None:
+        self.send(handler, status, json.dumps(body).encode(), {'Content-Type': 'application/json'})
+
+    def send(self, handler : Any, status : int, body : bytes, headers : Dict[str, str] = {}, length : Optional[int] = None) -> None:
+        handler.send_response(status)
+        for (key, value) in {**headers, 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET, HEAD, PATCH, POST, OPTIONS',
+                             'Access-Control-Allow-Headers': 'Authorization, Content-Type, Range', 'Access-Control-Expose-Headers': 'Content-Length, Content-Range, Retry-After'}.items():
+            handler.send_header(key, value)
+        handler.send_header('Content-Length', str(len(body) if length is None else length))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# What "graph-test-server.py DIR" puts in DIR if it's new, for the web app's testRenameFolderAsync: (path, sample in test/)
+GRAPH_TEST_TREE = [('album/a.jpg', 'eg-sony-cybershot - 2013.12.15 - 07.30 PST.jpg'), ('album/2013.12.15 - 07.32.37 - a.jpg', 'eg-sony-cybershot - 2013.12.15 - 07.30 PST.jpg'),
+                   ('album/b.jpg', 'eg-canon-ixus - 2013.12.15 - 07.30 PST.jpg'), ('album/c.mp4', 'eg-sony-cybershot - 2013.12.15 - 07.30 PST.mp4'), ('album/notes.txt', 'eg-notapic.txt'),
+                   ('album/more/d.jpg', 'eg-iphone4s - 2013.12.28 - 15.49 PST.jpg'), ('album/more/e.png', 'eg-screenshot.png'), ('album/more/deeper/f.jpg', 'eg-iphone5 - 2013.12.10 - 15.40 PST.jpg')]
+GRAPH_TEST_TREE += [(f'album/burst/IMG_{i:04}.jpg', 'eg-sony-cybershot - 2013.12.15 - 07.30 PST.jpg') for i in range(1, 25)]
+
+def make_graph_test_tree(dir : str) -> None:
+    samples = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test') # pic-rename.py's
+    for (path, sample) in GRAPH_TEST_TREE:
+        os.makedirs(os.path.dirname(os.path.join(dir, path)), exist_ok=True)
+        with open(os.path.join(samples, sample), 'rb') as file_in, open(os.path.join(dir, path), 'wb') as file_out:
+            file_out.write(file_in.read())
+
+def test_graph_server():
+    import shutil
+    import urllib.error
+    import urllib.request
+    tmp = f'/tmp/pic-rename/test_graph_server_{os.getpid()}'
+    server = None
+    def get(url : str, headers : Dict[str, str] = {}, method : str = 'GET', body : Any = None) -> Tuple[int, Dict[str, str], bytes]:
+        data = None if body is None else json.dumps(body).encode()
+        request = urllib.request.Request(url, data, {**headers, **({} if body is None else {'Content-Type': 'application/json'})}, method=method)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return (response.status, dict(response.headers), response.read())
+        except urllib.error.HTTPError as e:
+            return (e.code, dict(e.headers), e.read())
+    try:
+        make_graph_test_tree(tmp)
+        server = GraphServer(tmp)
+        graph = f'{server.url}/v1.0'
+        (status, _, body) = get(f'{graph}/me/drive/root/children')
+        assert(status == 200 and [item['name'] for item in json.loads(body)['value']] == ['album'])
+        album = json.loads(body)['value'][0]
+        items = {item['name']: item for item in json.loads(get(f'{graph}/me/drive/items/{album["id"]}/children')[2])['value']}
+        assert(sorted(items) == ['2013.12.15 - 07.32.37 - a.jpg', 'a.jpg', 'b.jpg', 'burst', 'c.mp4', 'more', 'notes.txt'] and 'folder' in items['more'])
+        # Download urls honour Range, as the web app's metadata parsers rely on, and HEAD gives the size
+        with open(os.path.join(tmp, 'album', 'a.jpg'), 'rb') as file:
+            jpg = file.read()
+        (status, headers, body) = get(items['a.jpg']['@microsoft.graph.downloadUrl'], {'Range': 'bytes=2-9'})
+        assert(status == 206 and body == jpg[2:10] and headers['Content-Range'] == f'bytes 2-9/{len(jpg)}' and headers['Access-Control-Allow-Origin'] == '*')
+        assert(get(items['a.jpg']['@microsoft.graph.downloadUrl'], method='HEAD')[1]['Content-Length'] == str(len(jpg)))
+        # Each rename in a batch is answered on its own; the item keeps its id
+        requests = [{'id': str(n), 'method': 'PATCH', 'url': f'/me/drive/items/{items[name]["id"]}', 'body': {'name': 'x.jpg'}} for (n, name) in enumerate(['a.jpg', 'b.jpg'])]
+        (status, _, body) = get(f'{graph}/$batch', method='POST', body={'requests': requests})
+        assert(status == 200 and [response['status'] for response in json.loads(body)['responses']] == [200, 409])
+        assert(json.loads(get(f'{graph}/me/drive/items/{items["a.jpg"]["id"]}')[2])['name'] == 'x.jpg' and os.path.exists(os.path.join(tmp, 'album', 'x.jpg')))
+        assert(get(f'{graph}/$batch', method='POST', body={'requests': requests * 11})[0] == 400) # more than 20
+        server.errors = 1.0
+        (status, _, body) = get(f'{graph}/$batch', method='POST', body={'requests': requests[1:]})
+        assert([(response['status'], response['headers']) for response in json.loads(body)['responses']] == [(429, {'Retry-After': '1'})])
+        assert(server.counts == {'children': 2, 'content': 2, 'batch': 3, 'batched_rename': 3})
+    finally:
+        if server is not None:
+            server.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def test_web_app():
+    # The web app's testRenameFolderAsync, run by node through test-rename.js (a stand-in for the browser's XMLHttpRequest
+    # and document), renames the tree while a quarter of the batched renames are throttled
+    import shutil
+    import subprocess
+    if shutil.which('node') is None:
+        print('test_web_app: skipped, as node isn\'t on the PATH', file=sys.stderr)
+        return
+    tmp = f'/tmp/pic-rename/test_web_app_{os.getpid()}'
+    server = None
+    try:
+        make_graph_test_tree(tmp)
+        server = GraphServer(tmp, errors=0.25)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test-rename.js')
+        subprocess.run(['node', script, f'{server.url}/v1.0', '4'], check=True, timeout=120)
+        renamed = len(GRAPH_TEST_TREE) - 3 # left as is: one already named, the .png without a date, and notes.txt
+        assert(server.counts['rename'] == 0 and server.counts['batch'] >= renamed / GraphServer.BATCH_LIMIT) # every rename went in a $batch
+        assert(server.counts['batched_rename'] > renamed) # and those that were throttled went again
+    finally:
+        if server is not None:
+            server.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='A local stand-in for OneDrive\'s Graph api, for testing the web app')
+    parser.add_argument('dir', nargs='?', metavar='DIR', help='serve the files under DIR (if DIR is new, it gets the tree the web app\'s testRenameFolderAsync expects)')
+    parser.add_argument('--port', type=int, default=8642, help='the port to serve on (default 8642)')
+    parser.add_argument('--latency', type=float, default=0.0, metavar='SECONDS', help='delay every response this long')
+    parser.add_argument('--error-rate', type=float, default=0.0, metavar='FRACTION', help='answer this fraction of the batched renames with 429')
+    parser.add_argument('--test', action='store_true', help='check the server, and the web app\'s renames against it')
+    parser.add_argument('--test-graph-server', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--test-web-app', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.test_graph_server:
+        test_graph_server()
+    elif args.test_web_app:
+        test_web_app()
+    elif args.test:
+        test_graph_server()
+        test_web_app()
+    elif args.dir is not None:
+        if not os.path.exists(args.dir):
+            make_graph_test_tree(args.dir)
+        graph_server = GraphServer(args.dir, args.port, args.latency, args.error_rate)
+        print(f'Serving {args.dir}; ctrl+c to stop. Open the web app with ?graph={graph_server.url}/v1.0#access_token=x, or in its console: testRenameFolderAsync(\'{graph_server.url}/v1.0\')', file=sys.stderr)
+        try:
+            graph_server.thread.join()
+        except KeyboardInterrupt:
+            sys.exit(130)
+    else:
+        parser.print_usage()
@@ -10,6 +10,10 @@ let USER_ID=""; // provided by onedrive in the URL; initialized in "onload"
 let poisonCount=0; // is incremented for each file we successfully rename (to avoid infinite relogin loops)
 let [currentIsCancelled, currentCancelCallbacks] = [false, []]; // every network fetch respects this callback
 let currentFetchCallback = () => {}; // every network fetch calls this callback
+let GRAPH_URL = 'https://graph.microsoft.com/v1.0'; // or a local stand-in, given as ?graph=http://127.0.0.1:PORT/v1.0, e.g. "graph-test-server.py DIR"
+let CONCURRENCY = 8; // how many items are fetched and geocoded at once; can be given as ?concurrency=N
+const GRAPH_BATCH_LIMIT = 20; // Graph takes at most this many requests in one $batch
+const BATCH_DELAY_MS = 250; // a batch of renames that isn't full is sent once no more have come for this long
 
 function resetCurrentCancel() {
     const callbacks = currentCancelCallbacks;
@@ -25,6 +29,10 @@ function cancelCurrentCancel() {
 onload = async () => {
     const url = new URL(location.href);
     const params = new URLSearchParams(url.hash.replace(/^#/,''));
+    if (url.searchParams.has('graph') && ['localhost', '127.0.0.1'].includes(new URL(url.searchParams.get('graph')).hostname)) {
+        GRAPH_URL = url.searchParams.get('graph'); // only a local one, since the access token is sent to it
+    }
+    if (url.searchParams.has('concurrency')) CONCURRENCY = Math.max(1, parseInt(url.searchParams.get('concurrency')) || 1);
     ACCESS_TOKEN = params.get("access_token");
     USER_ID = params.get("user_id");
     if (!ACCESS_TOKEN) {
@@ -37,7 +45,7 @@ onload = async () => {
     
     populateBrowser(0, null);
     try {
-        const items = JSON.parse(await fetchStringAsync('', 'https://graph.microsoft.com/v1.0/me/drive/root/children?$top=10000&select=name,id,size,folder,file', false, false)).value;
+        const items = JSON.parse(await fetchStringAsync('', `${GRAPH_URL}/me/drive/root/children?$top=10000&select=name,id,size,folder,file`, false, false)).value;
         populateBrowser(0, items);
     } catch (e) {
         if (e.message === 'Unauthorized') relogin();
@@ -224,15 +232,16 @@ async function clickBrowser(folderId) {
     // remove everything to the right, and update the location bar
     populateBrowser(parseInt(p.dataset.depth)+1, null);
     const selectedFolder = [...document.querySelectorAll("[data-selected='1']")].map(e => e.dataset.id).join(' ');
-    const params = new URLSearchParams({selectedFolder});
+    const params = new URLSearchParams(location.search); // keeping e.g. ?graph and ?concurrency
+    params.set('selectedFolder', selectedFolder);
     window.history.replaceState(null, null, `${location.pathname}?${params}${location.hash}`);
     // asynchronously populate the browser
-    const items = JSON.parse(await fetchStringAsync('', `https://graph.microsoft.com/v1.0/me/drive/items/${p.dataset.id}/children?$top=10000&select=name,id,size,folder,file`, false, false)).value;
+    const items = JSON.parse(await fetchStringAsync('', `${GRAPH_URL}/me/drive/items/${p.dataset.id}/children?$top=10000&select=name,id,size,folder,file`, false, false)).value;
     populateBrowser(parseInt(p.dataset.depth)+1, items);
 }
 
-function log(html) {
-    document.getElementById("log").insertAdjacentHTML('beforeend', html);
+function log(html, parent = document.getElementById("log")) {
+    parent.insertAdjacentHTML('beforeend', html);
 }
 
 async function renameFolder(folderId) {
@@ -241,9 +250,10 @@ async function renameFolder(folderId) {
     document.getElementById('rename').disabled = true;
     const p = document.querySelector(`[data-id='${folderId}']`);
     try {
-        await renameFolderRec([p.dataset.name], folderId, 0, parseInt(p.dataset.size));
+        await renameFolderTreeAsync([p.dataset.name], folderId, parseInt(p.dataset.size));
         log(`<span>All done.</span>`);
     } catch (e) {
+        cancelCurrentCancel(); // so that the items still underway stop too
         if (e.message === 'Unauthorized' && poisonCount > 0) relogin(true);
         else if (e.message === 'Cancelled') document.getElementById('log').innerHTML = '';
         else log(`<span class='error'>${e}</span>`);
@@ -251,83 +261,248 @@ async function renameFolder(folderId) {
     document.getElementById('log').scrollIntoView({behavior: "smooth", block: "end", inline: "end"});
 }
 
-async function renameFolderRec(folderPath, folderId, bytesDone, bytesTotal) {
-    log(`<h2><a href='https://onedrive.live.com/?id=${folderId}'>${folderPath.join(' &gt; ')}</a></h2>`);
-    const items = JSON.parse(await fetchStringAsync('', `https://graph.microsoft.com/v1.0/me/drive/items/${folderId}/children?$top=10000&select=name,id,size,folder,file,webUrl,@microsoft.graph.downloadUrl`)).value;
-    for (const item of items) {
-        if (item.folder) {
-            await renameFolderRec([...folderPath, item.name], item.id, bytesDone, bytesTotal);
-        } else if ('@microsoft.graph.downloadUrl' in item) {
-            log(`<table class='logitem' id='logitem_${item.id}'><tr><td rowspan='2' class='img'/><td class='name'/></tr><tr><td class='result'/></tr></table>`);
-            const logitem = document.getElementById(`logitem_${item.id}`);
-            const name = logitem.querySelector('.name');
-            const img = logitem.querySelector('.img');
-            const result = logitem.querySelector('.result');
-            name.innerHTML = `<a href='${item.webUrl}'>${item.name}</a>`;
-            document.getElementById('log').scrollIntoView({behavior: "smooth", block: "end", inline: "end"});
-            if (/^\d\d\d\d\.\d\d\.\d\d - \d\d\.\d\d\.\d\d/.test(item.name)) {
-                result.innerHTML = `<span class='info'>[left as is]</span>`;
-                continue;
-            }
-            const formats = ['.jpg', '.jpeg', '.jp2', '.jpx', '.png', '.heic', '.heif', '.tif', '.tiff', '.gif', '.psd', '.webp', '.mp4', '.mov', '.avif', '.webm', '.mkv', '.flv', '.vob', '.ogv', '.ogg', '.drc', '.gifv', '.avi', '.qt', '.asf', '.amv', '.m4p', '.mpg', '.mp2', '.mpeg', '.mpe', '.mpv', '.m2v', '.m4v', '.3gp', '.3g2'];
-            if (!formats.some(ext => item.name.toLowerCase().endsWith(ext))) {
-                result.innerHTML = `<span class='info'>[not an image]</span>`;
+/** Runs async tasks, at most `concurrency` of them at once, in the order they're given (except that urgent ones
+ * go to the front of the queue). With failFast, once a task has failed the ones still waiting fail with the same
+ * error rather than starting, so that e.g. 'Unauthorized' stops the whole rename.
+ */
+class WorkPool {
+    constructor(concurrency, failFast = false) {
+        this.concurrency = concurrency;
+        this.failFast = failFast;
+        this.running = 0;
+        this.waiting = []; // [task, resolve, reject]
+        this.failure = null;
+    }
+
+    /** Returns a promise for task's result, once it's had its turn
+     * @param {() => Promise<any>} task - the task to run
+     * @param {boolean} [urgent] - whether to put it ahead of those already waiting (default false)
+     */
+    run(task, urgent = false) {
+        return new Promise((resolve, reject) => {
+            if (urgent) this.waiting.unshift([task, resolve, reject]); else this.waiting.push([task, resolve, reject]);
+            this.startWaiting();
+        });
+    }
+
+    startWaiting() {
+        while (this.waiting.length > 0 && (this.running < this.concurrency || this.failure !== null)) {
+            const [task, resolve, reject] = this.waiting.shift();
+            if (this.failure !== null) {
+                reject(this.failure);
                 continue;
             }
-            img.innerHTML = `<div class="spinner"></div>`;
-            result.innerHTML = `<div class="spinner"></div> <span id="resolving">resolving...</span>`;
-            let fetchCount = 0;
-            currentFetchCallback = (s) => {
-                fetchCount ++;
-                const r = document.getElementById("resolving");
-                if (r === null) return;
-                r.innerText = `${s}#${fetchCount}`;
-            };
-            try {
-                const downloadUrl = item['@microsoft.graph.downloadUrl'];
-                const thumbnailPromise = fetchStringAsync('', `https://graph.microsoft.com/v1.0/me/drive/items/${item.id}/thumbnails/0/small`);
-                const namePromise = calculateNameAsync(downloadUrl);
-                thumbnailPromise.catch(() => {}); // since otherwise we might get runtime debugger complaints that no one caught the promise
-                namePromise.catch(() => {});
-                const thumbnail = JSON.parse(await thumbnailPromise);
-                const [thumbnailUrl, thumbnailWidth, thumbnailHeight] = [new URL(thumbnail['url']), thumbnail['width'], thumbnail['height']];
-                img.innerHTML = `<a href='${item.webUrl}'><img src='${thumbnailUrl}' style='width: ${thumbnailWidth}px; height: ${thumbnailHeight}px;'/></a>`;
-                document.getElementById('log').scrollIntoView({behavior: "smooth", block: "end", inline: "end"});
-                const [date, place, err] = await namePromise;
-                if (err !== null) {
-                    result.innerHTML = `<span class='error'>${err}</span>`;
-                    continue;
-                }
-                if (item.name.includes(date)) {
-                    result.innerHTML = `<span class='info'>[left as is]</span>`;
-                    continue;
-                }
-                for (let iCandidate=1; ; iCandidate++) {
-                    const oldName = item.name.replace(/^(.*)(\.[^\.]*)$/,'$1');
-                    const oldExt = item.name.replace(/^(.*)(\.[^\.]*)$/,'$2');
-                    const candidate = `${date} - ${place || oldName}${iCandidate === 1 ? '' : ` ${iCandidate}`}${oldExt}`;
-                    const request = JSON.stringify({name: candidate});
-                    try {
-                        await sendAndFetchStringAsync('onedrive:rename', `https://graph.microsoft.com/v1.0/me/drive/items/${item.id}`, 'PATCH', request, 'application/json');
-                        result.innerHTML = `${candidate}<br/><span class='info'>[renamed]</span>`;
-                        break;
-                    } catch (e) {
-                        if (e.message === 'Conflict') continue;
-                        throw e;
-                    }
-                    break;
-                }
-                poisonCount ++;
-            } catch (e) {
-                result.innerHTML = '';
-                img.innerHTML = '';
-                throw e;
+            this.running++;
+            task().then(resolve, (e) => {
+                if (this.failFast && this.failure === null) this.failure = e;
+                reject(e);
+            }).finally(() => {
+                this.running--;
+                this.startWaiting();
+            });
+        }
+    }
+}
+
+/** Renames items through Graph's $batch endpoint, up to GRAPH_BATCH_LIMIT renames per request, rather than a PATCH each.
+ * A batch is sent as soon as it's full, or once BATCH_DELAY_MS has passed without it filling up.
+ * Graph answers each request in a batch on its own, so each rename gets its own outcome: a Conflict for one
+ * item doesn't affect the others, and one that was throttled (429, 503 or 504) goes again in a later batch
+ * after its Retry-After.
+ */
+class RenameBatcher {
+    constructor() {
+        this.waiting = []; // {itemId, name, resolve, reject}
+        this.timer = null;
+        this.batchCount = 0;
+    }
+
+    /** Returns a promise that resolves once the item is renamed, or rejects e.g. with Error('Conflict') if the name is taken
+     * @param {string} itemId - the OneDrive item id
+     * @param {string} name - its new name
+     */
+    rename(itemId, name) {
+        return new Promise((resolve, reject) => this.enqueue({itemId, name, resolve, reject}));
+    }
+
+    enqueue(request) {
+        this.waiting.push(request);
+        if (this.waiting.length >= GRAPH_BATCH_LIMIT) this.send();
+        else if (this.timer === null) this.timer = setTimeout(() => this.send(), BATCH_DELAY_MS);
+    }
+
+    async send() {
+        clearTimeout(this.timer);
+        this.timer = null;
+        const batch = this.waiting.splice(0, GRAPH_BATCH_LIMIT);
+        if (this.waiting.length >= GRAPH_BATCH_LIMIT) this.send();
+        else if (this.waiting.length > 0) this.timer = setTimeout(() => this.send(), BATCH_DELAY_MS);
+        if (batch.length === 0) return;
+        this.batchCount++;
+        const requests = batch.map(({itemId, name}, i) => ({id: `${i}`, method: 'PATCH', url: `/me/drive/items/${itemId}`, body: {name}, headers: {'Content-Type': 'application/json'}}));
+        let responses;
+        try {
+            responses = JSON.parse(await sendAndFetchStringAsync('onedrive:batch', `${GRAPH_URL}/$batch`, 'POST', JSON.stringify({requests}), 'application/json')).responses;
+        } catch (e) {
+            for (const request of batch) request.reject(e);
+            return;
+        }
+        const answered = new Set();
+        for (const response of responses) {
+            const request = batch[parseInt(response.id)];
+            answered.add(request);
+            if (response.status >= 200 && response.status < 300) {
+                request.resolve();
+            } else if (response.status === 429 || response.status === 503 || response.status === 504) {
+                const seconds = parseInt((response.headers || {})['Retry-After']) || 1;
+                setTimeout(() => this.enqueue(request), seconds * 1000);
+            } else {
+                const message = response.status === 409 ? 'Conflict' : response.status === 401 ? 'Unauthorized' : `${response.status} ${response.body?.error?.message || 'rename failed'}`;
+                request.reject(new Error(message));
             }
         }
-        bytesDone += item.size;
+        for (const request of batch) {
+            if (!answered.has(request)) request.reject(new Error('missing from $batch response'));
+        }
     }
 }
 
+const placePool = new WorkPool(1); // Nominatim asks that we send it one request at a time
+const placePromises = new Map(); // by "lat,lon", so that the photos taken at one spot share a lookup
+
+/** As fetchPlaceAsync, but one lookup at a time, and only one for each spot
+ */
+function fetchPlaceSharedAsync([lat, lon]) {
+    const key = `${lat.toFixed(7)},${lon.toFixed(7)}`; // the precision of the urls
+    if (!placePromises.has(key)) {
+        const promise = placePool.run(() => fetchPlaceAsync([lat, lon]));
+        promise.catch(() => placePromises.delete(key)); // so that a later photo tries again
+        placePromises.set(key, promise);
+    }
+    return placePromises.get(key);
+}
+
+/** Renames every item under the folder. Items are worked on CONCURRENCY at a time: each one's thumbnail, Range fetches
+ * and geocoding overlap with the others', and the renames go off in batches meanwhile. Subfolders are listed as they're
+ * found, ahead of the items waiting their turn, so the whole tree is under way at once.
+ * @param {string[]} folderPath - the names of the folder and its parents, for the log
+ * @param {string} folderId - the OneDrive item id of the folder
+ * @param {number} bytesTotal - the size of the folder, for the progress
+ */
+async function renameFolderTreeAsync(folderPath, folderId, bytesTotal) {
+    log(`<p id='status'></p>`);
+    const status = document.getElementById('status');
+    const pool = new WorkPool(CONCURRENCY, true);
+    const batcher = new RenameBatcher();
+    const progress = {itemsTotal: 0, itemsDone: 0, bytesDone: 0, renamed: 0, fetches: 0};
+    progress.show = () => {
+        const percent = bytesTotal > 0 ? ` (${Math.round(100 * progress.bytesDone / bytesTotal)}%)` : '';
+        status.innerText = `${progress.itemsDone} of ${progress.itemsTotal} items done${percent}; ${progress.renamed} renamed; ${progress.fetches} fetches, ${batcher.batchCount} rename batches`;
+    };
+    currentFetchCallback = () => {
+        progress.fetches++;
+        progress.show();
+    };
+    try {
+        await renameFolderRec(folderPath, folderId, pool, batcher, progress);
+    } finally {
+        currentFetchCallback = () => {};
+        progress.show();
+    }
+    return progress;
+}
+
+async function renameFolderRec(folderPath, folderId, pool, batcher, progress) {
+    log(`<h2><a href='https://onedrive.live.com/?id=${folderId}'>${folderPath.join(' &gt; ')}</a></h2><div id='folder_${folderId}'></div>`);
+    const folderLog = document.getElementById(`folder_${folderId}`);
+    const items = JSON.parse(await pool.run(() => fetchStringAsync('', `${GRAPH_URL}/me/drive/items/${folderId}/children?$top=10000&select=name,id,size,folder,file,webUrl,@microsoft.graph.downloadUrl`), true)).value;
+    const names = new Set(items.map(item => item.name.toLowerCase())); // and then those we've claimed, as we rename
+    progress.itemsTotal += items.filter(item => !item.folder).length;
+    progress.show();
+    await Promise.all(items.map(async (item) => {
+        if (item.folder) {
+            await renameFolderRec([...folderPath, item.name], item.id, pool, batcher, progress);
+        } else if ('@microsoft.graph.downloadUrl' in item) {
+            const isRenamed = await renameItemAsync(item, folderLog, names, pool, batcher);
+            progress.itemsDone++;
+            progress.bytesDone += item.size;
+            progress.renamed += isRenamed ? 1 : 0;
+            progress.show();
+        }
+    }));
+}
+
+/** Renames the item to "date - place.ext", or the first of "date - place 2.ext", "date - place 3.ext"... that's free.
+ * Its thumbnail, metadata and place are fetched in its turn in the pool; the rename then goes through the batcher,
+ * without holding up the pool. names has the lowercased names in the item's folder, including those that items
+ * alongside it have claimed, so candidates rarely collide; if one does anyway, Graph's Conflict moves us on to the next.
+ * @returns {boolean} - whether it was renamed
+ */
+async function renameItemAsync(item, folderLog, names, pool, batcher) {
+    if (/^\d\d\d\d\.\d\d\.\d\d - \d\d\.\d\d\.\d\d/.test(item.name)) {
+        log(`<table class='logitem'><tr><td class='img'/><td class='name'><a href='${item.webUrl}'>${item.name}</a></td></tr><tr><td/><td class='result'><span class='info'>[left as is]</span></td></tr></table>`, folderLog);
+        return false;
+    }
+    const formats = ['.jpg', '.jpeg', '.jp2', '.jpx', '.png', '.heic', '.heif', '.tif', '.tiff', '.gif', '.psd', '.webp', '.mp4', '.mov', '.avif', '.webm', '.mkv', '.flv', '.vob', '.ogv', '.ogg', '.drc', '.gifv', '.avi', '.qt', '.asf', '.amv', '.m4p', '.mpg', '.mp2', '.mpeg', '.mpe', '.mpv', '.m2v', '.m4v', '.3gp', '.3g2'];
+    if (!formats.some(ext => item.name.toLowerCase().endsWith(ext))) {
+        log(`<table class='logitem'><tr><td class='img'/><td class='name'><a href='${item.webUrl}'>${item.name}</a></td></tr><tr><td/><td class='result'><span class='info'>[not an image]</span></td></tr></table>`, folderLog);
+        return false;
+    }
+    const [date, place, err, result] = await pool.run(async () => {
+        log(`<table class='logitem' id='logitem_${item.id}'><tr><td rowspan='2' class='img'/><td class='name'/></tr><tr><td class='result'/></tr></table>`, folderLog);
+        const logitem = document.getElementById(`logitem_${item.id}`);
+        const img = logitem.querySelector('.img');
+        const result = logitem.querySelector('.result');
+        logitem.querySelector('.name').innerHTML = `<a href='${item.webUrl}'>${item.name}</a>`;
+        document.getElementById('log').scrollIntoView({behavior: "smooth", block: "end", inline: "end"});
+        img.innerHTML = `<div class="spinner"></div>`;
+        result.innerHTML = `<div class="spinner"></div> <span class='info'>resolving...</span>`;
+        try {
+            const thumbnailPromise = fetchStringAsync('', `${GRAPH_URL}/me/drive/items/${item.id}/thumbnails/0/small`);
+            const namePromise = calculateNameAsync(item['@microsoft.graph.downloadUrl']);
+            thumbnailPromise.catch(() => {}); // since otherwise we might get runtime debugger complaints that no one caught the promise
+            namePromise.catch(() => {});
+            const thumbnail = JSON.parse(await thumbnailPromise);
+            const [thumbnailUrl, thumbnailWidth, thumbnailHeight] = [new URL(thumbnail['url']), thumbnail['width'], thumbnail['height']];
+            img.innerHTML = `<a href='${item.webUrl}'><img src='${thumbnailUrl}' style='width: ${thumbnailWidth}px; height: ${thumbnailHeight}px;'/></a>`;
+            return [...await namePromise, result];
+        } catch (e) {
+            result.innerHTML = '';
+            img.innerHTML = '';
+            throw e;
+        }
+    });
+    if (err !== null) {
+        result.innerHTML = `<span class='error'>${err}</span>`;
+        return false;
+    }
+    if (item.name.includes(date)) {
+        result.innerHTML = `<span class='info'>[left as is]</span>`;
+        return false;
+    }
+    result.innerHTML = `<div class="spinner"></div> <span class='info'>renaming...</span>`;
+    const oldName = item.name.replace(/^(.*)(\.[^\.]*)$/,'$1');
+    const oldExt = item.name.replace(/^(.*)(\.[^\.]*)$/,'$2');
+    for (let iCandidate=1; ; iCandidate++) {
+        const candidate = `${date} - ${place || oldName}${iCandidate === 1 ? '' : ` ${iCandidate}`}${oldExt}`;
+        if (names.has(candidate.toLowerCase())) continue;
+        names.add(candidate.toLowerCase());
+        try {
+            await batcher.rename(item.id, candidate);
+            names.delete(item.name.toLowerCase());
+            result.innerHTML = `${candidate}<br/><span class='info'>[renamed]</span>`;
+            break;
+        } catch (e) {
+            if (e.message === 'Conflict') continue; // someone else has it, so it stays in names
+            names.delete(candidate.toLowerCase());
+            result.innerHTML = '';
+            throw e;
+        }
+    }
+    poisonCount ++;
+    return true;
+}
+
 /** Parses an ISO6709 geolocation string like "+46.7888-124.0958" into a lat+lon pair [46.7888, -124.0958].
  * https://en.wikipedia.org/wiki/ISO_6709
  * The spec allows numbers to be decimal fractions like above, or degrees/minutes/seconds also with optional decimal fractions.
@@ -998,7 +1173,7 @@ async function fetchPlaceAsync([lat, lon]) {
  */
 async function calculateNameAsync(url, size) {
     const [localDate, utcDate, latlon, err] = await fetchDateLatLonAsync(url,size);
-    const [placeString, timeZone] = (latlon === null ? [null, null] : await fetchPlaceAsync(latlon));
+    const [placeString, timeZone] = (latlon === null ? [null, null] : await fetchPlaceSharedAsync(latlon));
     if (err !== null) return [null, null, err];
     if (localDate === null && utcDate === null) return [null, null, 'no timestamp'];
     if (localDate === null && utcDate !== null && latlon === null) return [null, null, 'no GPS'];
@@ -1239,6 +1414,31 @@ async function testPlace() {
     console.log("done");
 }
 
+/** Renames the tree that "graph-test-server.py DIR" puts in DIR (if it's new), and checks what it ends up as.
+ * Run it on the web app's page, with the server going, e.g. testRenameFolderAsync('http://127.0.0.1:8642/v1.0')
+ */
+async function testRenameFolderAsync(graphUrl = 'http://127.0.0.1:8642/v1.0', concurrency = 8) {
+    [GRAPH_URL, CONCURRENCY] = [graphUrl, concurrency];
+    resetCurrentCancel();
+    document.getElementById('log').innerHTML = '';
+    const album = JSON.parse(await fetchStringAsync('', `${GRAPH_URL}/me/drive/root/children`)).value.find(item => item.name === 'album');
+    const progress = await renameFolderTreeAsync(['album'], album.id, album.size);
+    const listAsync = async (folderId, prefix) => {
+        const names = [];
+        for (const item of JSON.parse(await fetchStringAsync('', `${GRAPH_URL}/me/drive/items/${folderId}/children`)).value) {
+            if (item.folder) names.push(...await listAsync(item.id, `${prefix}${item.name}/`));
+            else names.push(`${prefix}${item.name}`);
+        }
+        return names;
+    };
+    const burst = [...Array(24).keys()].map(i => `burst/2013.12.15 - 07.32.37 - IMG_${`000${i + 1}`.slice(-4)}.jpg`);
+    const expected = ['2013.12.15 - 07.31.41 - b.jpg', '2013.12.15 - 07.31.51 - c.mp4', '2013.12.15 - 07.32.37 - a 2.jpg', '2013.12.15 - 07.32.37 - a.jpg', ...burst,
+                      'more/2013.12.28 - 15.50.10 - d.jpg', 'more/deeper/2013.12.10 - 15.39.54 - f.jpg', 'more/e.png', 'notes.txt'];
+    assertEq((await listAsync(album.id, '')).sort(), expected.sort());
+    assertEq([progress.itemsDone, progress.renamed], [expected.length, expected.length - 3]);
+    console.log("done");
+}
+
 async function testHierarchy() {
     const base = new URL('https://unto.me/pic-rename/test/');
     const url = new URL('eg-android - 2013.11.23 - 12.49 PST.mp4', base);
@@ -0,0 +1,87 @@
+/**
+ * Runs the web app's testRenameFolderAsync under node, against graph-test-server.py, which starts it:
+ *   node test-rename.js http://127.0.0.1:PORT/v1.0 [concurrency]
+ * index.js is loaded as the page would load it, with just enough of XMLHttpRequest and document for the rename.
+ * Anything other than the Graph stand-in (Nominatim, say) is answered with a network error, as if offline.
+ */
+const fs = require('fs');
+const http = require('http');
+const path = require('path');
+const vm = require('vm');
+
+const [graphUrl, concurrency] = [process.argv[2], parseInt(process.argv[3] || '8')];
+const requests = []; // e.g. "POST http://127.0.0.1:PORT/v1.0/$batch"
+let [inFlight, maxInFlight] = [0, 0];
+
+/** The few bits of a DOM element that the rename touches; elements with an id are found again by getElementById
+ */
+const elements = new Map();
+function makeElement(id) {
+    const element = {id, innerHTML: '', innerText: '', style: {}, dataset: {}, scrollIntoView() {}, querySelector() { return makeElement(null); },
+        insertAdjacentHTML(where, html) { for (const match of html.matchAll(/id='([^']+)'/g)) elements.set(match[1], makeElement(match[1])); }};
+    if (id !== null) elements.set(id, element);
+    return element;
+}
+makeElement('log');
+
+/** XMLHttpRequest, as internalFetchAsync uses it, over node's http
+ */
+class XMLHttpRequest {
+    constructor() {
+        [this.DONE, this.readyState, this.headers] = [4, 0, {}];
+    }
+    open(verb, url) {
+        [this.verb, this.url] = [verb, url];
+    }
+    setRequestHeader(key, value) {
+        this.headers[key] = value;
+    }
+    getResponseHeader(key) {
+        return this.responseHeaders[key.toLowerCase()];
+    }
+    send(body) {
+        requests.push(`${this.verb} ${this.url}`);
+        if (!this.url.toString().startsWith(new URL(graphUrl).origin)) {
+            setTimeout(() => this.onerror(new Error(`offline: ${this.url}`)), 0);
+            return;
+        }
+        [inFlight, maxInFlight] = [inFlight + 1, Math.max(maxInFlight, inFlight + 1)];
+        if (body) this.headers['Content-Length'] = Buffer.byteLength(body);
+        const request = http.request(this.url, {method: this.verb, headers: this.headers}, (response) => {
+            const chunks = [];
+            response.on('data', chunk => chunks.push(chunk));
+            response.on('end', () => {
+                inFlight--;
+                const buf = Buffer.concat(chunks);
+                [this.status, this.statusText, this.responseHeaders, this.readyState] = [response.statusCode, response.statusMessage, response.headers, this.DONE];
+                [this.response, this.responseText] = [buf.buffer.slice(buf.byteOffset, buf.byteOffset + buf.length), buf.toString()];
+                if (this.onreadystatechange) this.onreadystatechange();
+                if (this.onload) this.onload();
+            });
+        });
+        request.on('error', e => {
+            inFlight--;
+            this.onerror(e);
+        });
+        request.end(body);
+    }
+}
+
+const context = {console, setTimeout, clearTimeout, URL, URLSearchParams, XMLHttpRequest, DataView, Uint8Array, Set, Map, Promise, JSON, Math, Date, Array, String, parseInt, parseFloat, Error, BigInt,
+    document: {getElementById: id => elements.get(id) || null, cookie: ''}, location: {href: 'http://127.0.0.1/', pathname: '/', search: '', hash: ''}, alert: console.log};
+vm.createContext(context);
+vm.runInContext(fs.readFileSync(path.join(__dirname, 'index.js'), 'utf8'), context);
+
+(async () => {
+    const start = Date.now();
+    [context.graphUrl, context.concurrency] = [graphUrl, concurrency];
+    try {
+        await vm.runInContext('testRenameFolderAsync(graphUrl, concurrency)', context);
+        const patches = requests.filter(request => request.startsWith('PATCH '));
+        if (patches.length > 0) throw new Error(`renamed without $batch: ${patches[0]}`);
+    } catch (e) {
+        console.error('test-rename.js: FAILED', e);
+        process.exit(1);
+    }
+    console.log(`${elements.get('status').innerText}; ${requests.length} requests, at most ${maxInFlight} at once, in ${Date.now() - start}ms`);
+})();